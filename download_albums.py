@@ -1,25 +1,43 @@
 import os
 import re
 import requests
-from bs4 import BeautifulSoup
-import time
+import urllib3
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-}
+from vk_common import detect_encoding, drop_cached, fetch_to_file
+
+# Number of images downloaded in parallel
+DEFAULT_WORKERS = 16
+# Size of the chunks fed to the HTML parser while looking for the page header
+PARSE_CHUNK_SIZE = 1 << 16
+
+# Only <img> tags are turned into soup; the rest of the page is skipped while parsing
+IMAGE_STRAINER = SoupStrainer("img")
+# Class of the page header block holding the breadcrumbs
+HEADER_CLASS = "page_block_header_inner"
+CRUMBS_XP = etree.XPath(
+    "(.//div[contains(concat(' ', normalize-space(@class), ' '), ' ui_crumb ')])[last()]"
+)
+
+# Precompiled patterns used for every image
+IMG_EXT_RE = re.compile(r"\.(jpe?g|png|gif)(\?.*)?$", re.IGNORECASE)
+# Query parameters that only sign a URL for a while; size, quality etc. pick a different image
+EPHEMERAL_PARAMS = {"sign", "c_uniq_tag"}
+# Characters that are invalid in file names, mapped to '_'
+BAD_TRANS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
 
 
 def read_file_with_encoding(file_path):
+    """Read a file as bytes together with its guessed encoding, leaving decoding to the parser."""
     try:
         with open(file_path, "rb") as file:
             raw_data = file.read()
-            # First, try UTF-8
-            try:
-                return raw_data.decode("utf-8")
-            except UnicodeDecodeError:
-                # Fallback to win-1251 for Russian
-                return raw_data.decode("windows-1251", errors="replace")
+            # Plain ASCII decodes the same either way; default to the Windows-1251 fallback
+            return raw_data, detect_encoding(raw_data) or "windows-1251"
     except Exception as e:
         print(f"Failed to read {file_path}: {e}")
         return None
@@ -27,80 +45,93 @@ def read_file_with_encoding(file_path):
 
 def sanitize_filename(name):
     """Sanitize a filename to make it valid for all file systems."""
-    name = re.sub(r'[<>:"/\\|?*]', '_', name)  # Replace invalid characters
-    name = re.sub(r'\.+$', '', name)  # Remove trailing dots
-    return name[:255]  # Limit the length to 255 characters
+    # Replace invalid characters, remove trailing dots, limit the length to 255 characters
+    return name.translate(BAD_TRANS).rstrip('.')[:255]
+
+
+def extract_album_name(raw_data, encoding):
+    """Extract album name from the page header, parsing the HTML only up to it."""
+    parser = etree.HTMLPullParser(events=("end",), tag="div", encoding=encoding)
+    for start in range(0, len(raw_data), PARSE_CHUNK_SIZE):
+        parser.feed(raw_data[start:start + PARSE_CHUNK_SIZE])
+        for _, elem in parser.read_events():
+            if HEADER_CLASS in elem.get("class", "").split():
+                crumbs = CRUMBS_XP(elem)
+                if crumbs:
+                    album_name = "".join(crumbs[0].itertext()).strip()
+                    return sanitize_filename(album_name)
+                return "Unknown Album"
+    return "Unknown Album"
 
 
-def extract_album_name(soup):
-    """Extract album name from the HTML soup."""
-    crumbs = soup.select_one(".page_block_header_inner")
-    if crumbs:
-        album_name = crumbs.find_all("div", class_="ui_crumb")[-1].text.strip()
-        return sanitize_filename(album_name)
-    return "Unknown Album"
+def image_key(src):
+    """Identify an image URL regardless of its ephemeral signature parameters."""
+    base, _, query = src.partition("?")
+    params = [p for p in query.split("&") if p and p.partition("=")[0] not in EPHEMERAL_PARAMS]
+    return f"{base}?{'&'.join(params)}" if params else base
 
 
 def extract_images(soup):
-    """Extract image URLs and alt names from the HTML soup."""
-    images = []
+    """Extract unique image URLs, alt names and URL extensions from the HTML soup."""
+    # Repeated images keep the last occurrence, like clashing file names in process_album
+    images = {}
     for img_tag in soup.find_all("img"):
         src = img_tag.get("src")
         alt = img_tag.get("alt", "unknown_image")
-        if src and re.search(r"\.(jpe?g|png|gif)(\?.*)?$", src, re.IGNORECASE):
-            images.append((src, alt))
-    return images
-
-
-def download_image(url, save_path, retries=3, delay=5):
-    """Download an image from a URL with retry logic."""
-    for attempt in range(retries):
-        try:
-            response = requests.get(url, headers=HEADERS, stream=True, timeout=10)
-            if response.status_code >= 400 and response.status_code < 500:
-                print(f"Skipping {url}: HTTP {response.status_code} - Client error, will not retry.")
-                return False
-
-            response.raise_for_status()
-
-            # Use the same extension as in the URL
-            ext_match = re.search(r"\.(jpe?g|png|gif)(\?.*)?$", url, re.IGNORECASE)
-            extension = ext_match.group(1) if ext_match else "jpg"
-            save_path = re.sub(r"\.\w+$", f".{extension}", save_path)
-
-            with open(save_path, "wb") as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            print(f"Downloaded: {save_path}")
-            return True
-        except requests.exceptions.RequestException as e:
-            print(f"Attempt {attempt + 1} failed for {url}: {e}")
-            time.sleep(delay)
-    print(f"Failed to download {url} after {retries} attempts.")
-    return False
-
-
-def process_album(html_file, download_dir):
+        ext_match = IMG_EXT_RE.search(src) if src else None
+        if ext_match:
+            images[image_key(src)] = (src, alt, ext_match.group(1))
+    return list(images.values())
+
+
+def download_image(url, save_path, force=False, saved=None):
+    """Download an image from a URL, retrying if the body is cut off.
+
+    If a list is passed as ``saved``, the path is appended to it once the image is saved.
+    """
+    if not force and os.path.exists(save_path):
+        print(f"File already exists, skipping: {save_path}")
+        return True
+
+    try:
+        if not fetch_to_file(url, save_path, saved=saved):
+            return False
+        print(f"Downloaded: {save_path}")
+        return True
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        print(f"Failed to download {url}: {e}")
+        return False
+
+
+def process_album(html_file, download_dir, force=False, workers=DEFAULT_WORKERS):
     """Process a single album HTML file."""
     content = read_file_with_encoding(html_file)
     if content is None:
         return
 
-    soup = BeautifulSoup(content, "html.parser")
-
-    album_name = extract_album_name(soup)
+    raw_data, encoding = content
+    album_name = extract_album_name(raw_data, encoding)
+    soup = BeautifulSoup(raw_data, "lxml", from_encoding=encoding, parse_only=IMAGE_STRAINER)
     images = extract_images(soup)
 
     # Create a directory for the album
     album_dir = os.path.join(download_dir, album_name)
     os.makedirs(album_dir, exist_ok=True)
 
-    # Download all images
-    for src, alt in images:
-        # Create a valid file name for the image
-        file_name = sanitize_filename(alt) + os.path.splitext(src)[-1].split('?')[0]
+    # Collect download jobs; images sharing a file name keep the last URL,
+    # as they would overwrite each other when downloaded one by one
+    jobs = {}
+    for src, alt, extension in images:
+        # Create a valid file name for the image, using the same extension as in the URL
+        file_name = f"{sanitize_filename(alt)}.{extension}"
         save_path = os.path.join(album_dir, file_name)
-        download_image(src, save_path)
+        jobs[save_path] = src
+
+    # Download all images concurrently
+    saved = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(partial(download_image, force=force, saved=saved), jobs.values(), jobs.keys()))
+    drop_cached(saved)
 
 
 def main():
@@ -110,20 +141,24 @@ def main():
                         help="Path to the root directory of VK albums.")
     parser.add_argument("--download-dir", type=str, required=True,
                         help="Path to the directory where images will be downloaded.")
+    parser.add_argument("--force", action="store_true",
+                        help="Force re-download of existing files.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of parallel downloads.")
     args = parser.parse_args()
 
     root_dir = args.root_dir
     download_dir = args.download_dir
 
     html_files = [
-        os.path.join(root_dir, file)
-        for file in os.listdir(root_dir)
-        if file.endswith(".html")
+        entry.path
+        for entry in os.scandir(root_dir)
+        if entry.is_file() and entry.name.endswith(".html")
     ]
 
     for html_file in html_files:
         print(f"Processing album: {html_file}")
-        process_album(html_file, download_dir)
+        process_album(html_file, download_dir, force=args.force, workers=args.workers)
 
 
 if __name__ == "__main__":
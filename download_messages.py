@@ -1,36 +1,59 @@
 import os
 import re
-import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 
 import requests
-from bs4 import BeautifulSoup
+import urllib3
+from lxml import etree
 from datetime import datetime
-from charset_normalizer import detect
 
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+from vk_common import (
+    BODY_RETRIES, RATE_LIMITER, SESSION, THROTTLE_STATUSES, drop_cached, fetch_to_file, sniff_encoding,
+)
+
+# Number of attachments downloaded in parallel
+DEFAULT_WORKERS = 16
+
+# Precompiled patterns used for every attachment
+IMG_EXT_RE = re.compile(r"\.(jpe?g|png|gif)(\?.*)?$", re.IGNORECASE)
+EXT_REPLACE_RE = re.compile(r"\.\w+$")
+RED_RE = re.compile(r"\(ред\.\)")
+CYRILLIC_RE = re.compile("[\u0400-\u04FF]")
+# Russian month abbreviations, translated in a single pass before strptime
+RU_MONTHS = {
+    "янв": "Jan", "фев": "Feb", "мар": "Mar", "апр": "Apr", "мая": "May", "июн": "Jun",
+    "июл": "Jul", "авг": "Aug", "сен": "Sep", "окт": "Oct", "ноя": "Nov", "дек": "Dec"
 }
+RU_MONTHS_RE = re.compile("|".join(map(re.escape, RU_MONTHS)))
+# Characters that are invalid in file names, mapped to '_'
+BAD_TRANS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
 
-def read_file_with_encoding(file_path):
-    """Read a file with automatic encoding detection."""
-    with open(file_path, "rb") as f:
-        raw_data = f.read()
-        result = detect(raw_data)
-        encoding = result["encoding"]
-
-        # Limit to UTF-8 and Windows-1251
-        if encoding and encoding.lower() in ["utf-8", "windows-1251"]:
-            return raw_data.decode(encoding, errors="replace"), encoding
-        else:
-            # Fallback to Windows-1251 if encoding is unrecognized or unsupported
-            return raw_data.decode("windows-1251", errors="replace"), "windows-1251"
-
-def extract_contact_name(soup, chat_dir):
-    """Extract the contact's name from the HTML soup and add UID if "DELETED"."""
-    crumbs = soup.select_one(".page_block_header_inner")
+
+def _has_class(name):
+    """Build an XPath predicate matching elements that carry the given CSS class."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Classes of the blocks that hold a single message while stream-parsing
+MESSAGE_CLASSES = {"message", "item"}
+# Size of the chunks fed to the streaming HTML parser
+PARSE_CHUNK_SIZE = 1 << 16
+
+# Class of the page header block holding the breadcrumbs
+HEADER_CLASS = "page_block_header_inner"
+
+# Compiled once: a message's header and attachment link, and the page header crumbs
+HEADER_XP = etree.XPath(f"(.//*[{_has_class('message__header')}])[1]")
+LINK_XP = etree.XPath(f"(.//a[{_has_class('attachment__link')}])[1]/@href")
+CRUMBS_XP = etree.XPath(f".//div[{_has_class('ui_crumb')}]")
+
+
+def extract_contact_name(crumbs, chat_dir):
+    """Extract the contact's name from the page header crumbs and add UID if "DELETED"."""
     if crumbs:
-        contact_name = crumbs.find_all("div", class_="ui_crumb")[-1].text.strip()
+        contact_name = crumbs[-1]
         if contact_name == "DELETED":
             uid = os.path.basename(chat_dir)  # Get the folder name as UID
             contact_name = f"DELETED_{uid}"
@@ -38,6 +61,8 @@ def extract_contact_name(soup, chat_dir):
     return "Unknown Contact"
 
 
+# Messages often share a timestamp, so parsed dates are memoized
+@lru_cache(maxsize=8192)
 def parse_date_en(date_text):
     """Parse English date format."""
     try:
@@ -46,133 +71,216 @@ def parse_date_en(date_text):
         return None
 
 
+@lru_cache(maxsize=8192)
 def parse_date_ru(date_text):
     """Parse Russian date format."""
     try:
-        months = {
-            "янв": "Jan", "фев": "Feb", "мар": "Mar", "апр": "Apr", "мая": "May", "июн": "Jun",
-            "июл": "Jul", "авг": "Aug", "сен": "Sep", "окт": "Oct", "ноя": "Nov", "дек": "Dec"
-        }
-        for ru, en in months.items():
-            date_text = date_text.replace(ru, en)
+        date_text = RU_MONTHS_RE.sub(lambda m: RU_MONTHS[m.group(0)], date_text)
         return datetime.strptime(date_text, "%d %b %Y в %H:%M:%S")
     except ValueError:
         return None
 
 
-def extract_attachments(soup):
-    """Extract attachments and their corresponding dates from the HTML soup."""
-    attachments = set()
-    for message in soup.select(".message, .item"):
-        header = message.select_one(".message__header")
-        if header:
-            date_text = header.text.strip()
-            # Remove sender's name if present
-            if "," in date_text:
-                date_text = date_text.rsplit(",", 1)[-1].strip()
-            # Remove '(ред.)' if present
-            date_text = re.sub(r"\(ред\.\)", "", date_text).strip()
-
-            message_date = parse_date_en(date_text) or parse_date_ru(date_text)
-            if not message_date:
-                continue
+def extract_attachment(message):
+    """Extract the image attachment and its date from a single message element."""
+    headers = HEADER_XP(message)
+    if not headers:
+        return None
 
-            formatted_date = message_date.strftime("%Y-%m-%d %H:%M:%S")
-            attachment_link = message.select_one(".attachment__link")
-            if attachment_link:
-                url = attachment_link["href"]
-                # Skip non-image links
-                if not re.search(r"\.(jpe?g|png|gif)(\?.*)?$", url, re.IGNORECASE):
-                    continue
-                attachments.add((url, formatted_date))
-    return list(attachments)
+    date_text = "".join(headers[0].itertext()).strip()
+    # Remove sender's name if present
+    if "," in date_text:
+        date_text = date_text.rsplit(",", 1)[-1].strip()
+    # Remove '(ред.)' if present
+    date_text = RED_RE.sub("", date_text).strip()
+
+    # Only Russian dates contain Cyrillic, so English archives skip the month translation
+    if CYRILLIC_RE.search(date_text):
+        message_date = parse_date_ru(date_text)
+    else:
+        message_date = parse_date_en(date_text)
+    if not message_date:
+        return None
 
+    links = LINK_XP(message)
+    # Skip messages without links and non-image links
+    if not links or not IMG_EXT_RE.search(links[0]):
+        return None
+    return links[0], message_date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def iter_attachments(file_path, crumbs=None):
+    """Stream-parse a message file and yield (url, date) for each image attachment.
+
+    Every message block is released as soon as its closing tag has been handled,
+    so memory use stays flat regardless of the size of the file. The raw bytes
+    are decoded by lxml itself. If a list is passed as ``crumbs``, it is filled
+    with the texts of the page header crumbs.
+    """
+    def drain():
+        for _, elem in parser.read_events():
+            classes = elem.get("class", "").split()
+            if crumbs is not None and not crumbs and HEADER_CLASS in classes:
+                crumbs.extend("".join(crumb.itertext()).strip() for crumb in CRUMBS_XP(elem))
+            if MESSAGE_CLASSES.isdisjoint(classes):
+                continue
+            attachment = extract_attachment(elem)
+            if attachment:
+                yield attachment
+            # Free the handled message and everything before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-def download_attachment(url, save_path, allowed_mime_types=None):
-    """Download an attachment from a URL with MIME type validation and save it to the specified path."""
+    with open(file_path, "rb") as f:
+        encoding, chunks = sniff_encoding(iter(lambda: f.read(PARSE_CHUNK_SIZE), b""))
+        parser = etree.HTMLPullParser(events=("end",), tag="div", encoding=encoding)
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from drain()
+    parser.close()
+    yield from drain()
+
+
+def mime_type(headers):
+    """Return the MIME type of a response's Content-Type header, without its parameters."""
+    return headers.get('Content-Type', '').split(';')[0].strip()
+
+
+def head_check(session, url, allowed_mime_types):
+    """Check a URL with a HEAD request before downloading its body.
+
+    Returns the reason to skip the download (None if it may go ahead) and the
+    announced Content-Length (0 if unknown). Throttled requests are retried once
+    the rate limiter allows. Only client errors and disallowed MIME types are
+    final: server errors and servers that do not support HEAD leave it to the GET.
+    """
+    for attempt in range(1, BODY_RETRIES + 1):
+        RATE_LIMITER.wait(url)
+        response = session.head(url, timeout=5, allow_redirects=True)
+        RATE_LIMITER.update(url, response, attempt)
+        if response.status_code not in THROTTLE_STATUSES:
+            break
+
+    if response.status_code == 405 or response.status_code >= 500:
+        return None, 0
+    content_type = mime_type(response.headers)
+    content_length = response.headers.get('Content-Length', '')
+    content_length = int(content_length) if content_length.isdigit() else 0
+    if response.status_code >= 400:
+        return f"HTTP {response.status_code}", content_length
+    if content_type not in allowed_mime_types:
+        return f"MIME type '{content_type}' not allowed", content_length
+    return None, content_length
+
+
+def download_attachment(url, save_path, allowed_mime_types=None, session=SESSION, force=False, saved=None):
+    """Download an attachment from a URL with MIME type validation and save it to the specified path.
+
+    Unless ``force`` is set, an existing file is kept if the HEAD check announces
+    no size or the same size as the file's. If a list is passed as ``saved``, the
+    path is appended to it once the attachment is saved.
+    """
     if allowed_mime_types is None:
         allowed_mime_types = ['image/jpeg', 'image/png', 'image/gif']
 
-    try:
-        response = requests.get(url, headers=HEADERS, stream=True, timeout=10)
-        if 400 <= response.status_code < 500:
-            print(f"Skipping {url}: HTTP {response.status_code} - Client error, will not retry.")
-            return False
+    # Use the same extension as in the URL
+    ext_match = IMG_EXT_RE.search(url)
+    extension = ext_match.group(1) if ext_match else "jpg"
 
-        response.raise_for_status()
+    save_path = EXT_REPLACE_RE.sub(f".{extension}", save_path)
 
-        # Check MIME type
-        content_type = response.headers.get('Content-Type', '')
-        if content_type not in allowed_mime_types:
-            print(f"Skipping {url}: MIME type '{content_type}' not allowed.")
+    try:
+        # Cheap pre-check so rejected links and complete files never transfer a body
+        reason, content_length = head_check(session, url, allowed_mime_types)
+        if reason:
+            print(f"Skipping {url}: rejected by HEAD check, {reason}.")
+            return False
+        if (not force and os.path.exists(save_path)
+                and content_length in (0, os.path.getsize(save_path))):
+            print(f"File already exists, skipping: {save_path}")
+            return True
+
+        def check_mime_type(response):
+            content_type = mime_type(response.headers)
+            if content_type not in allowed_mime_types:
+                return f"MIME type '{content_type}' not allowed."
+            return None
+
+        if not fetch_to_file(url, save_path, session=session, validate=check_mime_type, saved=saved):
             return False
-
-        # Use the same extension as in the URL
-        ext_match = re.search(r"\.(jpe?g|png|gif)(\?.*)?$", url, re.IGNORECASE)
-        extension = ext_match.group(1) if ext_match else "jpg"
-
-        save_path = re.sub(r"\.\w+$", f".{extension}", save_path)
-
-        with open(save_path, "wb") as file:
-            for chunk in response.iter_content(1024):
-                file.write(chunk)
         print(f"Downloaded: {save_path}")
         return True
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         print(f"Failed to download {url}: {e}")
         return False
 
 
 def sanitize_filename(name):
     """Sanitize the filename to make it valid for all file systems."""
-    name = re.sub(r'[<>:"/\\|?*]', '_', name)  # Replace invalid characters
-    name = re.sub(r'\.+$', '', name)  # Remove trailing dots
-    return name[:255]  # Limit the length to 255 characters
+    # Replace invalid characters, remove trailing dots, limit the length to 255 characters
+    return name.translate(BAD_TRANS).rstrip('.')[:255]
 
 
-def download_with_retries(url, save_path, retries=3, delay=5, allowed_mime_types=None, force=False):
-    """Download a file with retries if the initial attempt fails."""
-    if not force and os.path.exists(save_path):
-        print(f"File already exists, skipping: {save_path}")
-        return True
+def page_number(filename):
+    """Return the page index N of a messagesN.html file name."""
+    number = filename[len("messages"):-len(".html")]
+    return int(number) if number.isdigit() else float("inf")
+
+
+def parse_one(file_path):
+    """Parse a single message file and return its header crumbs and unique (url, date) attachments."""
+    crumbs = []
+    # dict keeps the first occurrence of each attachment in page order
+    attachments = list(dict.fromkeys(iter_attachments(file_path, crumbs)))
+    return crumbs, attachments
 
-    for attempt in range(retries):
-        if download_attachment(url, save_path, allowed_mime_types=allowed_mime_types):
-            return True  # Download succeeded
-        print(f"Attempt {attempt + 1} failed for {url}. Retrying...")
-        time.sleep(delay)
-    print(f"Failed to download {url} after {retries} attempts.")
-    return False
 
+def download_and_report(url, save_path, force, session, saved=None):
+    """Download a single attachment and report success."""
+    if download_attachment(url, save_path, allowed_mime_types=['image/jpeg', 'image/png'],
+                           session=session, force=force, saved=saved):
+        print(f"File is processed successfully: {save_path}")
 
-def process_chat(chat_dir, download_dir, force):
+
+def process_chat(chat_dir, download_dir, force, parser_pool, session=SESSION, workers=DEFAULT_WORKERS):
     """Process all paginated message files in a chat directory."""
-    first_file = os.path.join(chat_dir, "messages0.html")
-    if not os.path.exists(first_file):
+    if not os.path.exists(os.path.join(chat_dir, "messages0.html")):
         return
 
-    soup = BeautifulSoup(read_file_with_encoding(first_file)[0], "html.parser")
-    contact_name = extract_contact_name(soup, chat_dir)
+    # Pages in order, messages0.html first
+    filenames = sorted(
+        (filename for filename in os.listdir(chat_dir)
+         if filename.startswith("messages") and filename.endswith(".html")),
+        key=page_number,
+    )
+    file_paths = [os.path.join(chat_dir, filename) for filename in filenames]
+
+    # Parse all paginated message files in parallel; every page is read once
+    pages = list(parser_pool.map(parse_one, file_paths))
+
+    # The contact's name comes from the header of the first page
+    contact_name = extract_contact_name(pages[0][0], chat_dir)
     sanitized_name = sanitize_filename(contact_name)
 
     # Create a directory for the contact
     contact_dir = os.path.join(download_dir, sanitized_name)
     os.makedirs(contact_dir, exist_ok=True)
 
-    # Process all paginated message files
-    for filename in os.listdir(chat_dir):
-        if filename.startswith("messages") and filename.endswith(".html"):
-            file_path = os.path.join(chat_dir, filename)
-            soup = BeautifulSoup(read_file_with_encoding(file_path)[0], "html.parser")
-            attachments = extract_attachments(soup)
+    jobs = {}
+    for _, attachments in pages:
+        for url, date in attachments:
+            file_name = sanitize_filename(f"{date}.jpg")  # Only sanitize the filename
+            save_path = os.path.join(contact_dir, file_name)  # Keep the directory structure intact
+            # Attachments sharing a timestamp map to the same file; keep the first one
+            jobs.setdefault(save_path, url)
 
-            # Download all attachments
-            for url, date in attachments:
-                file_name = sanitize_filename(f"{date}.jpg")  # Only sanitize the filename
-                save_path = os.path.join(contact_dir, file_name)  # Keep the directory structure intact
-                if download_with_retries(url, save_path, retries=3, delay=5,
-                                         allowed_mime_types=['image/jpeg', 'image/png'], force=force):
-                    print(f"File is processed successfully: {save_path}")
+    # Download all attachments concurrently over the shared session
+    saved = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(partial(download_and_report, force=force, session=session, saved=saved),
+                          jobs.values(), jobs.keys()))
+    drop_cached(saved)
 
 
 def main():
@@ -182,20 +290,23 @@ def main():
     parser.add_argument("--download-dir", type=str, required=True,
                         help="Path to the directory where attachments will be downloaded.")
     parser.add_argument("--force", action="store_true", help="Force re-download of existing files.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of parallel downloads.")
     args = parser.parse_args()
 
     root_dir = args.root_dir
     download_dir = args.download_dir
 
     chat_dirs = [
-        os.path.join(root_dir, folder)
-        for folder in os.listdir(root_dir)
-        if os.path.isdir(os.path.join(root_dir, folder))
+        entry.path
+        for entry in os.scandir(root_dir)
+        if entry.is_dir()
     ]
 
-    for chat_dir in chat_dirs:
-        print(f"Processing chat: {chat_dir}")
-        process_chat(chat_dir, download_dir, force=args.force)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as parser_pool:
+        for chat_dir in chat_dirs:
+            print(f"Processing chat: {chat_dir}")
+            process_chat(chat_dir, download_dir, force=args.force, parser_pool=parser_pool,
+                         session=SESSION, workers=args.workers)
 
 
 if __name__ == "__main__":
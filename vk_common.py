@@ -0,0 +1,270 @@
+"""HTTP session, rate limiting, encoding detection and file saving shared by the downloaders."""
+import codecs
+import itertools
+import os
+import re
+import shutil
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+}
+
+# Buffer size used when writing downloaded bodies to disk
+COPY_BUFFER_SIZE = 1 << 16
+# Number of bytes, from the first non-ASCII one, used to guess the encoding of an HTML file
+ENCODING_SAMPLE_SIZE = 4096
+# Fewest bytes, from the first non-ASCII one, that tell a truncated UTF-8 character from Windows-1251
+ENCODING_MIN_SAMPLE = 4
+# First byte that is not ASCII; the encoding is guessed from the bytes starting there
+NON_ASCII_RE = re.compile(rb"[\x80-\xff]")
+# Most leading ASCII held back while waiting for bytes that reveal the encoding
+ENCODING_HOLD_LIMIT = 256 * 1024
+
+# Shared session so connections to the VK CDN are kept alive and pooled per host
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# Transient failures are retried by urllib3 with exponential backoff. Throttling (429/503)
+# is left to the rate limiter, which paces every worker and caps the wait.
+RETRY = Retry(
+    total=3,
+    backoff_factor=1.0,
+    status_forcelist=[500, 502, 504],
+    allowed_methods=["GET", "HEAD"],
+    # Otherwise urllib3 retries any 429/503 carrying Retry-After regardless of the list above
+    respect_retry_after_header=False,
+    # Hand the final error response back instead of raising, so the callers can report it
+    raise_on_status=False,
+)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=RETRY)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Statuses by which a host asks to slow down; they are retried once the limiter allows it
+THROTTLE_STATUSES = (429, 503)
+# The adapter only retries getting a response; a body cut off mid-copy is retried by the downloaders
+BODY_RETRIES = 3
+BODY_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.ReadTimeoutError,
+)
+
+
+class HostRateLimiter:
+    """Per-host pacing driven by the rate-limit headers of the server's responses.
+
+    Requests to a host wait until the time the host last asked for. 429/503
+    responses and other failed attempts additionally back off exponentially
+    in the caller's attempt number, up to ``max_delay`` seconds.
+    """
+
+    def __init__(self, max_delay=60):
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._next_allowed = {}  # host -> time.monotonic() before which nothing is sent
+
+    def wait(self, url):
+        """Sleep until requests to the URL's host are allowed again."""
+        host = urlparse(url).netloc
+        with self._lock:
+            delay = self._next_allowed.get(host, 0) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, url, response, attempt=1):
+        """Record the limits announced by a response to the given attempt at a URL."""
+        delay = header_delay(response.headers)
+        if response.status_code in THROTTLE_STATUSES:
+            # Counted per request, so a burst of throttled workers does not escalate the host
+            delay = max(delay, 2 ** attempt)
+        self._hold(url, delay)
+
+    def backoff(self, url, attempt):
+        """Hold requests to the URL's host back after the given attempt at it failed."""
+        self._hold(url, 2 ** attempt)
+
+    def _hold(self, url, delay):
+        """Allow no requests to the URL's host for the next delay seconds."""
+        if delay <= 0:
+            return
+        host = urlparse(url).netloc
+        until = time.monotonic() + min(delay, self.max_delay)
+        with self._lock:
+            self._next_allowed[host] = max(self._next_allowed.get(host, 0), until)
+
+
+def header_delay(headers):
+    """Return the number of seconds a response asks to wait via Retry-After or X-RateLimit-*."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError):
+            pass
+
+    # Only wait for the reset once the quota is used up
+    reset = headers.get("X-RateLimit-Reset")
+    if headers.get("X-RateLimit-Remaining") == "0" and reset and reset.isdigit():
+        reset = int(reset)
+        # Either an absolute Unix timestamp or a number of seconds from now
+        return reset - time.time() if reset > 1_000_000_000 else reset
+    return 0
+
+
+RATE_LIMITER = HostRateLimiter()
+
+
+def detect_encoding(data, final=True):
+    """Guess UTF-8 or Windows-1251 from the first non-ASCII bytes of data.
+
+    Returns None while data is plain ASCII, as ASCII alone cannot tell the two apart.
+    If more data may follow (``final`` false), also returns None while fewer than
+    ``ENCODING_MIN_SAMPLE`` bytes follow the first non-ASCII one.
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8"
+    match = NON_ASCII_RE.search(data)
+    if not match:
+        return None
+    # The sample starts right after an ASCII byte, so on a character boundary
+    sample = data[match.start():match.start() + ENCODING_SAMPLE_SIZE]
+    if not final and len(sample) < ENCODING_MIN_SAMPLE:
+        return None
+    # A sample cut from the middle of the data may end in the middle of a multi-byte character
+    final = final and match.start() + ENCODING_SAMPLE_SIZE >= len(data)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=final)
+        return "utf-8"
+    except UnicodeDecodeError:
+        # Fallback to Windows-1251 for Russian
+        return "windows-1251"
+
+
+def sniff_encoding(chunks, hold_limit=ENCODING_HOLD_LIMIT):
+    """Guess the encoding of HTML read in chunks, looking no further than needed.
+
+    Returns the encoding and an iterator over all the chunks: the ones read to
+    decide are held back and come first. Pages that stay ASCII for
+    ``hold_limit`` bytes, or to their end, get the Windows-1251 fallback.
+    """
+    chunks = iter(chunks)
+    held = []
+    size = 0
+    # The last few bytes read; an undecided sample can only start there
+    tail = b""
+    for chunk in chunks:
+        held.append(chunk)
+        size += len(chunk)
+        sample = tail + chunk
+        encoding = detect_encoding(sample, final=False)
+        if encoding:
+            break
+        tail = sample[1 - ENCODING_MIN_SAMPLE:]
+        # Past the limit, only wait for the rest of a sample that has already started
+        if size >= hold_limit and not NON_ASCII_RE.search(tail):
+            break
+    else:
+        encoding = detect_encoding(tail)
+    return encoding or "windows-1251", itertools.chain(held, chunks)
+
+
+def fetch_to_file(url, save_path, session=SESSION, validate=None, saved=None):
+    """Download a URL to save_path, retrying if the host throttles or the body is cut off.
+
+    ``validate`` may inspect the response before its body is read and return a
+    reason to skip it. If a list is passed as ``saved``, save_path is appended to
+    it once written, for ``drop_cached`` later. Returns whether the file was
+    saved; request errors that persist after the retries are raised.
+    """
+    for attempt in range(1, BODY_RETRIES + 1):
+        RATE_LIMITER.wait(url)
+        # The response is closed on every exit, so its connection never stays checked out
+        with session.get(url, stream=True, timeout=10) as response:
+            RATE_LIMITER.update(url, response, attempt)
+            if response.status_code >= 400:
+                # Error bodies are short: read them so the connection can be reused
+                response.raw.drain_conn()
+            if response.status_code in THROTTLE_STATUSES:
+                # The limiter has recorded the backoff; the next attempt waits for it
+                print(f"Attempt {attempt} throttled for {url}: HTTP {response.status_code}.")
+                continue
+            if 400 <= response.status_code < 500:
+                print(f"Skipping {url}: HTTP {response.status_code} - Client error, will not retry.")
+                return False
+
+            response.raise_for_status()
+
+            reason = validate(response) if validate else None
+            if reason:
+                print(f"Skipping {url}: {reason}")
+                return False
+
+            try:
+                save_response(response, save_path)
+                if saved is not None:
+                    saved.append(save_path)
+                return True
+            except BODY_ERRORS as e:
+                if attempt == BODY_RETRIES:
+                    raise
+                print(f"Attempt {attempt} failed for {url}: {e}. Retrying...")
+                # The next attempt waits for the backoff, like a throttled one
+                RATE_LIMITER.backoff(url, attempt)
+    print(f"Skipping {url}: still throttled after {BODY_RETRIES} attempts.")
+    return False
+
+
+def save_response(response, save_path):
+    """Stream a response body to save_path and start writing it out.
+
+    The body is written to a ``.part`` file that only replaces save_path once
+    complete, so an interrupted download is never mistaken for a finished one.
+    Its pages stay cached until written out; ``drop_cached`` releases them.
+    """
+    # Let urllib3 undo any Content-Encoding and copy the body in large blocks
+    response.raw.decode_content = True
+    part_path = save_path + ".part"
+    try:
+        with open(part_path, "wb") as file:
+            shutil.copyfileobj(response.raw, file, length=COPY_BUFFER_SIZE)
+            if hasattr(os, "posix_fadvise"):
+                # DONTNEED only drops clean pages; on the fresh, dirty file it starts writeback
+                # without waiting for it, and the pages are dropped by drop_cached later
+                file.flush()
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        os.replace(part_path, save_path)
+    except BaseException:
+        try:
+            os.unlink(part_path)
+        except OSError:
+            pass
+        raise
+
+
+def drop_cached(paths):
+    """Ask the kernel to drop the cached pages of saved files, once they have been written out.
+
+    Downloads are rarely read back soon, so the cache is better left to other files.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)